@@ -2,13 +2,14 @@
 
 import streamlit as st
 import google.generativeai as genai
-import PIL.Image
 import io
-import time
 import base64
+import hashlib
 import speech_recognition as sr
-from gtts import gTTS
 from pydub import AudioSegment
+import job_service
+from blob_store import BlobExpired, blob_store
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Page Config
 st.set_page_config(page_title="Cultural Tour Mate", layout="wide")
@@ -45,7 +46,10 @@ t = translations[lang_code]
 # Gemini API Config
 GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
 genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-pro-vision')
+MODEL_NAME = 'gemini-pro-vision'
+
+# Background job workers (generation and TTS survive Streamlit reruns)
+JOB_DB = job_service.start_workers(api_key=GOOGLE_API_KEY)
 
 # Session State
 if "messages" not in st.session_state:
@@ -55,41 +59,92 @@ if "messages" not in st.session_state:
 if "image_part" not in st.session_state:
     st.session_state["image_part"] = None
 
+# Image/audio bytes live in blob_store keyed by content hash; the session only keeps references
+session_id = get_script_run_ctx().session_id
+blob_store.touch(session_id)
+
+
+def resolve_parts(messages):
+    """Swap blob references in the chat history for inline data parts before sending to Gemini.
+
+    Images that have expired or been evicted are left out.
+    """
+    resolved = []
+    for msg in messages:
+        if isinstance(msg["parts"], list):
+            parts = []
+            for p in msg["parts"]:
+                if isinstance(p, dict):
+                    try:
+                        p = blob_store.part(p["blob"])
+                    except BlobExpired:
+                        continue
+                parts.append(p)
+            msg = {"role": msg["role"], "parts": parts}
+        resolved.append(msg)
+    return resolved
+
 # Image Upload
 st.markdown(f"## {t['title']}")
 image_file = st.file_uploader(t["upload_image"], type=["jpg", "jpeg", "png", "webp"])
 
 if image_file:
-    image = PIL.Image.open(image_file)
-    st.image(image, caption="Uploaded Image", use_column_width=True)
-    with io.BytesIO() as output:
-        image.save(output, format="JPEG")
-        compressed = output.getvalue()
-    st.session_state["image_part"] = {"mime_type": "image/jpeg", "data": compressed}
+    st.image(image_file, caption="Uploaded Image", use_column_width=True)
+    raw = image_file.getvalue()
+    digest = hashlib.sha256(raw).hexdigest()
+    # Only preprocess a new image once; reruns reuse the stored result
+    image_part = st.session_state["image_part"]
+    if st.session_state.get("image_src") != digest or not image_part or image_part["blob"] not in blob_store:
+        job_id = job_service.submit("preprocess", {"data": raw}, db_path=JOB_DB)
+        job = job_service.wait(job_id, db_path=JOB_DB)
+        if job and job["status"] == "done":
+            # Earlier images stay referenced by the chat history until the session expires
+            blob = blob_store.put(job["result"], "image/jpeg", session_id)
+            st.session_state["image_part"] = {"mime_type": "image/jpeg", "blob": blob}
+            st.session_state["image_src"] = digest
+        else:
+            st.error(f"❌ Failed to process image: {job['error'] if job else 'job expired'}")
 
 # Voice Input
 st.markdown("---")
 st.markdown("### 🎙️ Voice Input (语音输入)")
 audio_file = st.file_uploader("Upload a voice message (mp3/wav)", type=["mp3", "wav"])
 if audio_file:
-    st.audio(audio_file)
-    recognizer = sr.Recognizer()
-    audio_path = f"/tmp/{audio_file.name}"
-    with open(audio_path, "wb") as f:
-        f.write(audio_file.read())
-    if audio_file.name.endswith(".mp3"):
-        sound = AudioSegment.from_mp3(audio_path)
-        wav_path = audio_path.replace(".mp3", ".wav")
-        sound.export(wav_path, format="wav")
-        audio_path = wav_path
-    with sr.AudioFile(audio_path) as source:
-        audio_data = recognizer.record(source)
-        try:
-            recognized_text = recognizer.recognize_google(audio_data, language="zh-CN" if lang_code == "zh" else "en-US")
-            st.success("📝 " + t["user_role"] + ": " + recognized_text)
-            prompt = recognized_text
-        except Exception as e:
-            st.error(f"❌ Could not recognize audio: {e}")
+    raw = audio_file.getvalue()
+    mime_type = "audio/mpeg" if audio_file.name.endswith(".mp3") else "audio/wav"
+    try:
+        audio_blob = blob_store.put(raw, mime_type, session_id)
+        st.audio(blob_store.source(audio_blob), format=mime_type)
+    except (ValueError, BlobExpired) as e:
+        audio_blob = None
+        st.error(f"❌ Could not load audio: {e}")
+    old_blob = st.session_state.get("audio_blob")
+    if old_blob and old_blob != audio_blob:
+        blob_store.release(session_id, old_blob)
+    st.session_state["audio_blob"] = audio_blob
+
+    prompt = None
+    recognized = st.session_state.get("recognized")
+    if audio_blob and recognized and recognized["blob"] == audio_blob:
+        prompt = recognized["text"]
+        st.success("📝 " + t["user_role"] + ": " + prompt)
+    else:
+        # Decode in memory; nothing is written under the uploaded file name
+        wav = io.BytesIO(raw)
+        if mime_type == "audio/mpeg":
+            wav = io.BytesIO()
+            AudioSegment.from_file(io.BytesIO(raw), format="mp3").export(wav, format="wav")
+            wav.seek(0)
+        recognizer = sr.Recognizer()
+        with sr.AudioFile(wav) as source:
+            audio_data = recognizer.record(source)
+            try:
+                recognized_text = recognizer.recognize_google(audio_data, language="zh-CN" if lang_code == "zh" else "en-US")
+                st.success("📝 " + t["user_role"] + ": " + recognized_text)
+                prompt = recognized_text
+                st.session_state["recognized"] = {"blob": audio_blob, "text": recognized_text}
+            except Exception as e:
+                st.error(f"❌ Could not recognize audio: {e}")
 else:
     prompt = st.text_area(t["ask_question"], height=100)
 
@@ -98,23 +153,47 @@ enable_speech = st.checkbox("🔊 Read aloud the response", value=True)
 if st.button(t["submit_button"]):
     if not prompt:
         st.warning("Please enter a question.")
-    elif not st.session_state["image_part"]:
+    elif not st.session_state["image_part"] or st.session_state["image_part"]["blob"] not in blob_store:
         st.warning("Please upload an image first.")
     else:
-        with st.spinner("Generating response..."):
-            st.session_state["messages"].append({"role": "user", "parts": [prompt, st.session_state["image_part"]]})
-            try:
-                response = model.generate_content(st.session_state["messages"])
-                st.session_state["messages"].append({"role": "model", "parts": [response.text]})
-                st.markdown("#### " + t["response_title"])
-                st.write(response.text)
-                if enable_speech:
-                    tts = gTTS(text=response.text, lang="zh" if lang_code == "zh" else "en")
-                    mp3_fp = f"/tmp/response_audio_{int(time.time())}.mp3"
-                    tts.save(mp3_fp)
-                    st.audio(mp3_fp, format="audio/mp3")
-            except Exception as e:
-                st.error(f"❌ Failed to generate response: {e}")
+        st.session_state["messages"].append({"role": "user", "parts": [prompt, st.session_state["image_part"]]})
+        try:
+            job_id = job_service.submit(
+                "generate", {"model": MODEL_NAME, "contents": resolve_parts(st.session_state["messages"])},
+                db_path=JOB_DB)
+            st.session_state["pending_job"] = {"id": job_id, "speech": enable_speech}
+        except Exception as e:
+            st.error(f"❌ Failed to generate response: {e}")
+
+# Wait for the background job; a rerun mid-request resumes waiting on the same job ID
+pending_job = st.session_state.get("pending_job")
+if pending_job:
+    with st.spinner("Generating response..."):
+        job = job_service.wait(pending_job["id"], db_path=JOB_DB)
+    st.session_state["pending_job"] = None
+    if job and job["status"] == "done":
+        st.session_state["messages"].append({"role": "model", "parts": [job["result"]]})
+        st.markdown("#### " + t["response_title"])
+        st.write(job["result"])
+        if pending_job["speech"]:
+            st.session_state["pending_tts"] = job_service.submit(
+                "tts", {"text": job["result"], "lang": "zh" if lang_code == "zh" else "en"}, db_path=JOB_DB)
+    else:
+        st.error(f"❌ Failed to generate response: {job['error'] if job else 'job expired'}")
+
+pending_tts = st.session_state.get("pending_tts")
+if pending_tts:
+    job = job_service.wait(pending_tts, db_path=JOB_DB)
+    st.session_state["pending_tts"] = None
+    if job and job["status"] == "done":
+        tts_blob = blob_store.put(job["result"], "audio/mpeg", session_id)
+        old_blob = st.session_state.get("tts_blob")
+        if old_blob and old_blob != tts_blob:
+            blob_store.release(session_id, old_blob)
+        st.session_state["tts_blob"] = tts_blob
+        st.audio(blob_store.source(tts_blob), format="audio/mp3")
+    else:
+        st.error(f"❌ Failed to synthesize speech: {job['error'] if job else 'job expired'}")
 
 # Chat History
 st.markdown("---")
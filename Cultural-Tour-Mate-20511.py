@@ -2,8 +2,10 @@ import streamlit as st
 import google.generativeai as genai
 import dotenv
 import os
-from PIL import Image
-from io import BytesIO
+import hashlib
+import job_service
+from blob_store import BlobExpired, blob_store
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # 页面配置
 st.set_page_config(page_title="Cultural-Tour-Mate", layout="centered")
@@ -13,6 +15,8 @@ dotenv.load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 if os.getenv("GOOGLE_API_KEY") is None:
     st.error("❌ Google API Key not found. Please check .env file.")
+# 启动后台任务进程（已在运行则跳过）
+JOB_DB = job_service.start_workers(api_key=os.getenv("GOOGLE_API_KEY"))
 
 # 多语言支持
 t = {
@@ -126,13 +130,28 @@ if "messages" not in st.session_state:
     st.session_state["messages"] = [ {"role": "system", "content": "Your Cultural-Tour-Mate, a helpful and culturally knowledgeable travel assistant. Don't hesitate to ask..." if lang_code == "en" else "您的文化旅行旅伴，旅途上遇见任何问题都可以问我..."}]
 
 
-# 图像压缩
-def compress_image(image, max_size=(800, 800), quality=80):
-    image = image.convert("RGB")  # 保证 JPEG 兼容性
-    image.thumbnail(max_size)
-    buf = BytesIO()
-    image.save(buf, format="JPEG", quality=quality)
-    return buf.getvalue()
+# 会话标识：图像数据按内容哈希存放在 blob_store，会话只保存哈希引用
+session_id = get_script_run_ctx().session_id
+blob_store.touch(session_id)
+
+
+# 图像压缩（交给后台任务；同一张图只处理一次，rerun 时直接复用结果）
+def preprocess_image(raw):
+    digest = hashlib.sha256(raw).hexdigest()
+    old = st.session_state.get("image_part")
+    if st.session_state.get("image_src") == digest and old and old["blob"] in blob_store:
+        return True
+    job_id = job_service.submit("preprocess", {"data": raw}, db_path=JOB_DB)
+    job = job_service.wait(job_id, db_path=JOB_DB)
+    if not job or job["status"] != "done":
+        st.error(job["error"] if job else "Image preprocessing job expired.")
+        return False
+    blob = blob_store.put(job["result"], "image/jpeg", session_id)
+    if old and old["blob"] != blob:
+        blob_store.release(session_id, old["blob"])
+    st.session_state["image_part"] = {"mime_type": "image/jpeg", "blob": blob}
+    st.session_state["image_src"] = digest
+    return True
 
 image_part = None
 
@@ -161,10 +180,8 @@ if st.session_state["show_camera"]:
         # 处理压缩
         if len(camera_img.getvalue()) > 3 * 1024 * 1024:
             st.warning(text["oversize_error"])
-        else:
-            img = Image.open(camera_img)
-            st.session_state["image_part"] = {"mime_type": "image/jpeg", "data": compress_image(img)}
-            st.image(img, caption=text["photo_captured"], use_container_width=True)
+        elif preprocess_image(camera_img.getvalue()):
+            st.image(camera_img, caption=text["photo_captured"], use_container_width=True)
 
 # 上传模块
 st.divider()
@@ -174,10 +191,8 @@ upload_img = st.file_uploader(label="", type=["jpg", "jpeg", "png", "webp"])
 if upload_img:
     if upload_img.size > 3 * 1024 * 1024:
         st.warning(text["oversize_error"])
-    else:
-        img = Image.open(upload_img)
-        st.session_state["image_part"] = {"mime_type": "image/jpeg", "data": compress_image(img)}
-        st.image(img, caption=text["photo_uploaded"], use_container_width=True)
+    elif preprocess_image(upload_img.getvalue()):
+        st.image(upload_img, caption=text["photo_uploaded"], use_container_width=True)
 
 # 输入与提问
 # 提问表单（支持回车键提交 + 语言提示）
@@ -196,28 +211,43 @@ with st.form("question_form", clear_on_submit=True):  # 这里设置True
 # 提交后处理部分
 image_part = st.session_state.get("image_part")
 if submitted:
-    if prompt and image_part:
-        # 在处理新消息前显示spinner
-        with st.spinner("🧠 Generating insight..." if lang_code == "en" else "🧠 正在思考，请稍候..."):
-            try:
-                model = genai.GenerativeModel("gemini-1.5-pro")
-                response = model.generate_content([prompt, image_part])
-                response_text = response.text
-                
-                # 添加到消息历史
-                new_messages = [
-                    {"role": "user", "content": prompt},
-                    {"role": "assistant", "content": response_text}
-                ]
-                st.session_state["messages"].extend(new_messages)
-                
-            except Exception as e:
-                st.error(text["api_error"])
-                st.exception(e)
+    if prompt and image_part and image_part["blob"] in blob_store:
+        try:
+            # 提交到后台任务进程，任务 ID 存入会话；rerun 不会中断生成
+            job_id = job_service.submit("generate", {"model": "gemini-1.5-pro",
+                                                     "contents": [prompt, blob_store.part(image_part["blob"])]},
+                                        db_path=JOB_DB)
+            st.session_state["pending_job"] = {"id": job_id, "prompt": prompt}
+        except BlobExpired:
+            # 图像已过期或被缓存淘汰，需要重新上传
+            st.session_state["image_part"] = None
+            st.warning(text["text_unsendable"])
+        except Exception as e:
+            st.error(text["api_error"])
+            st.exception(e)
 
     else:
         st.warning(text["text_unsendable"])
 
+# 等待生成结果（中途被 rerun 打断后，下次运行会继续等待同一个任务）
+pending_job = st.session_state.get("pending_job")
+if pending_job:
+    # 在处理新消息前显示spinner
+    with st.spinner("🧠 Generating insight..." if lang_code == "en" else "🧠 正在思考，请稍候..."):
+        job = job_service.wait(pending_job["id"], db_path=JOB_DB)
+    st.session_state["pending_job"] = None
+
+    if job and job["status"] == "done":
+        # 添加到消息历史
+        new_messages = [
+            {"role": "user", "content": pending_job["prompt"]},
+            {"role": "assistant", "content": job["result"]}
+        ]
+        st.session_state["messages"].extend(new_messages)
+    else:
+        st.error(text["api_error"])
+        st.exception(RuntimeError(job["error"] if job else "Generation job expired."))
+
 # 显示对话历史（最新的对话在最上面，并用st.divider()分隔）
 if len(st.session_state["messages"]) > 1: # 确保至少有一轮对话
     st.markdown("### " + text["response_title"])
@@ -269,7 +299,10 @@ if len(st.session_state["messages"]) > 1:  # 有对话记录才显示按钮
             }
         ]
         # 重置上传图片数据
+        blob_store.release(session_id)
         st.session_state["image_part"] = None
+        st.session_state["image_src"] = None
+        st.session_state["pending_job"] = None
         # 关闭相机视图
         st.session_state["show_camera"] = False
         # 重置用户输入（可选，确保表单输入框为空）
@@ -2,8 +2,11 @@ import streamlit as st
 import google.generativeai as genai
 import dotenv
 import os
-from PIL import Image
-from io import BytesIO
+import hashlib
+import job_service
+from blob_store import BlobExpired, blob_store
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from single_flight import generate_flight, make_key
 
 # 页面配置
 st.set_page_config(page_title="Cultural-Tour-Mate", layout="centered")
@@ -13,6 +16,8 @@ dotenv.load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 # 读取 Secrets
 genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+# 启动后台任务进程（已在运行则跳过）
+JOB_DB = job_service.start_workers(api_key=st.secrets["GEMINI_API_KEY"])
 if os.getenv("GOOGLE_API_KEY") is None:
     st.error("❌ Google API Key not found. Please check .env file.")
 
@@ -128,13 +133,28 @@ if "messages" not in st.session_state:
     st.session_state["messages"] = [ {"role": "system", "content": "Your Cultural-Tour-Mate, a helpful and culturally knowledgeable travel assistant. Don't hesitate to ask..." if lang_code == "en" else "您的文化旅行旅伴，旅途上遇见任何问题都可以问我..."}]
 
 
-# 图像压缩
-def compress_image(image, max_size=(800, 800), quality=80):
-    image = image.convert("RGB")  # 保证 JPEG 兼容性
-    image.thumbnail(max_size)
-    buf = BytesIO()
-    image.save(buf, format="JPEG", quality=quality)
-    return buf.getvalue()
+# 会话标识：图像数据按内容哈希存放在 blob_store，会话只保存哈希引用
+session_id = get_script_run_ctx().session_id
+blob_store.touch(session_id)
+
+
+# 图像压缩（交给后台任务；同一张图只处理一次，rerun 时直接复用结果）
+def preprocess_image(raw):
+    digest = hashlib.sha256(raw).hexdigest()
+    old = st.session_state.get("image_part")
+    if st.session_state.get("image_src") == digest and old and old["blob"] in blob_store:
+        return True
+    job_id = job_service.submit("preprocess", {"data": raw}, db_path=JOB_DB)
+    job = job_service.wait(job_id, db_path=JOB_DB)
+    if not job or job["status"] != "done":
+        st.error(job["error"] if job else "Image preprocessing job expired.")
+        return False
+    blob = blob_store.put(job["result"], "image/jpeg", session_id)
+    if old and old["blob"] != blob:
+        blob_store.release(session_id, old["blob"])
+    st.session_state["image_part"] = {"mime_type": "image/jpeg", "blob": blob}
+    st.session_state["image_src"] = digest
+    return True
 
 image_part = None
 
@@ -163,10 +183,8 @@ if st.session_state["show_camera"]:
         # 处理压缩
         if len(camera_img.getvalue()) > 3 * 1024 * 1024:
             st.warning(text["oversize_error"])
-        else:
-            img = Image.open(camera_img)
-            st.session_state["image_part"] = {"mime_type": "image/jpeg", "data": compress_image(img)}
-            st.image(img, caption=text["photo_captured"], use_container_width=True)
+        elif preprocess_image(camera_img.getvalue()):
+            st.image(camera_img, caption=text["photo_captured"], use_container_width=True)
 
 # 上传模块
 st.divider()
@@ -176,10 +194,8 @@ upload_img = st.file_uploader(label="", type=["jpg", "jpeg", "png", "webp"])
 if upload_img:
     if upload_img.size > 3 * 1024 * 1024:
         st.warning(text["oversize_error"])
-    else:
-        img = Image.open(upload_img)
-        st.session_state["image_part"] = {"mime_type": "image/jpeg", "data": compress_image(img)}
-        st.image(img, caption=text["photo_uploaded"], use_container_width=True)
+    elif preprocess_image(upload_img.getvalue()):
+        st.image(upload_img, caption=text["photo_uploaded"], use_container_width=True)
 
 # 输入与提问
 # 提问表单（支持回车键提交 + 语言提示）
@@ -198,64 +214,95 @@ with st.form("question_form", clear_on_submit=True):  # 这里设置True
 # 提交后处理部分
 image_part = st.session_state.get("image_part")
 if submitted:
-    if prompt and image_part:
-# 在处理新消息前显示spinner
-        with st.spinner("🧠 Generating insight..." if lang_code == "en" else "🧠 正在思考，请稍候..."):
+    if prompt and image_part and image_part["blob"] in blob_store:
+        try:
+            # ✅ 自动检测模型（容错）
+            available_models = []
             try:
-                import google.generativeai as genai
-        
-                # ✅ 自动检测模型（容错）
-                available_models = []
-                try:
-                    available_models = [m.name for m in genai.list_models()]
-                except Exception:
-                    st.warning("⚠️ Unable to list models, using default gemini-1.5-flash.")
-        
-                # ✅ 模型选择逻辑
-                if any("gemini-1.5-pro" in m for m in available_models):
-                    model_name = "gemini-1.5-pro"
-                elif any("gemini-1.5-flash" in m for m in available_models):
-                    model_name = "gemini-1.5-flash"
-                else:
-                    model_name = "gemini-1.5-flash"
-                    st.warning("⚠️ Gemini 1.5 模型未检测到，已默认使用 gemini-1.5-flash")
-        
-                # ✅ 初始化模型
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content([prompt, image_part])
-                response_text = getattr(response, "text", str(response))
-        
-                # ✅ 保存消息
-                new_messages = [
-                    {"role": "user", "content": prompt},
-                    {"role": "assistant", "content": response_text}
-                ]
-                st.session_state["messages"].extend(new_messages)
-        
-            except Exception as e:
-                st.error(text["api_error"])
-                st.exception(e)
-                st.info(
-                    "💡 提示：\n"
-                    "1️⃣ 请确认 requirements.txt 中包含：`google-generativeai>=0.8.3 setuptools`\n"
-                    "2️⃣ 请确保 API Key 来自新版 Google AI Studio（https://aistudio.google.com/app/apikey）。\n"
-                    "3️⃣ 可尝试手动设置模型名为 gemini-1.5-flash。"
-                )
-
-                # 添加到消息历史
-                new_messages = [
-                    {"role": "user", "content": prompt},
-                    {"role": "assistant", "content": response_text}
-                ]
-                st.session_state["messages"].extend(new_messages)
-                
-            except Exception as e:
-                st.error(text["api_error"])
-                st.exception(e)
+                available_models = [m.name for m in genai.list_models()]
+            except Exception:
+                st.warning("⚠️ Unable to list models, using default gemini-1.5-flash.")
+
+            # ✅ 模型选择逻辑
+            if any("gemini-1.5-pro" in m for m in available_models):
+                model_name = "gemini-1.5-pro"
+            elif any("gemini-1.5-flash" in m for m in available_models):
+                model_name = "gemini-1.5-flash"
+            else:
+                model_name = "gemini-1.5-flash"
+                st.warning("⚠️ Gemini 1.5 模型未检测到，已默认使用 gemini-1.5-flash")
+
+            # ✅ 记录待生成的请求（只保存图像哈希，图像字节不进入 session_state），下面统一提交并流式显示
+            st.session_state["pending_job"] = {
+                "key": make_key(image_part["blob"], prompt, lang_code),
+                "prompt": prompt,
+                "model": model_name,
+                "blob": image_part["blob"],
+            }
+
+        except Exception as e:
+            st.error(text["api_error"])
+            st.exception(e)
 
     else:
         st.warning(text["text_unsendable"])
 
+def ask_gemini(model_name, prompt, blob):
+    """提交生成任务并逐段产出结果；第一个分段是任务 ID。"""
+    job_id = job_service.submit(
+        "generate",
+        {"model": model_name, "contents": [prompt, blob_store.part(blob)], "stream": True},
+        db_path=JOB_DB,
+    )
+    yield job_id
+    yield from job_service.stream(job_id, db_path=JOB_DB)
+
+
+# 流式显示生成结果
+pending_job = st.session_state.get("pending_job")
+if pending_job:
+    placeholder = st.empty()
+    try:
+        if pending_job.get("id"):
+            # 已有任务 ID（rerun 打断后回来，无论多久）：直接按 ID 取结果，不再经过合并层
+            chunks = job_service.stream(pending_job["id"], db_path=JOB_DB)
+        else:
+            # 相同图像 + 问题 + 语言的并发请求共享同一次提交和流式输出；任务失败后不保留，重试会重新提交
+            chunks = generate_flight.stream(
+                pending_job["key"],
+                lambda: ask_gemini(pending_job["model"], pending_job["prompt"], pending_job["blob"]),
+            )
+            pending_job["id"] = next(chunks)  # 任务 ID 存入会话
+        # 在处理新消息前显示spinner
+        with st.spinner("🧠 Generating insight..." if lang_code == "en" else "🧠 正在思考，请稍候..."):
+            with placeholder.container():
+                response_text = st.write_stream(chunks)
+        placeholder.empty()
+        st.session_state["pending_job"] = None
+
+        # ✅ 保存消息
+        new_messages = [
+            {"role": "user", "content": pending_job["prompt"]},
+            {"role": "assistant", "content": response_text}
+        ]
+        st.session_state["messages"].extend(new_messages)
+
+    except BlobExpired:
+        # 图像已过期或被缓存淘汰，需要重新上传
+        st.session_state["pending_job"] = None
+        st.session_state["image_part"] = None
+        st.warning(text["text_unsendable"])
+    except Exception as e:
+        st.session_state["pending_job"] = None
+        st.error(text["api_error"])
+        st.exception(e)
+        st.info(
+            "💡 提示：\n"
+            "1️⃣ 请确认 requirements.txt 中包含：`google-generativeai>=0.8.3 setuptools`\n"
+            "2️⃣ 请确保 API Key 来自新版 Google AI Studio（https://aistudio.google.com/app/apikey）。\n"
+            "3️⃣ 可尝试手动设置模型名为 gemini-1.5-flash。"
+        )
+
 # 显示对话历史（最新的对话在最上面，并用st.divider()分隔）
 if len(st.session_state["messages"]) > 1: # 确保至少有一轮对话
     st.markdown("### " + text["response_title"])
@@ -307,7 +354,10 @@ if len(st.session_state["messages"]) > 1:  # 有对话记录才显示按钮
             }
         ]
         # 重置上传图片数据
+        blob_store.release(session_id)
         st.session_state["image_part"] = None
+        st.session_state["image_src"] = None
+        st.session_state["pending_job"] = None
         # 关闭相机视图
         st.session_state["show_camera"] = False
         # 重置用户输入（可选，确保表单输入框为空）
@@ -315,3 +365,9 @@ if len(st.session_state["messages"]) > 1:  # 有对话记录才显示按钮
             del st.session_state["prompt_input"]
         # 立即刷新页面
         st.rerun()
+
+# 调试信息：URL 加上 ?debug=1 时显示请求合并统计
+if st.query_params.get("debug"):
+    with st.expander("🛠️ Debug"):
+        st.caption("Single-flight: calls = 提问数, executed = Gemini 调用数, coalesced = 合并省下的调用数, failed = 失败数")
+        st.json(generate_flight.stats())
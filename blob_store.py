@@ -0,0 +1,198 @@
+# 图像 / 音频二进制数据的统一存储
+#
+# 以前 JPEG 原始字节一直放在 session_state 里，音频和 TTS 文件以用户上传的文件名写进 /tmp 且从不删除。
+# 这里按内容哈希只保存一份，会话只持有哈希引用：
+#   - 内存占用超过 ram_limit 时，最久未使用的数据溢写到磁盘缓存目录（文件名为哈希，不使用用户文件名）；
+#     磁盘缓存超过 disk_limit 时淘汰磁盘上最久未使用的数据，内存和磁盘占用都有上限；
+#     被淘汰或已过期的数据访问时抛出 BlobExpired，页面据此提示重新上传；
+#   - 每个会话对其引用的数据计数，会话空闲超过 session_ttl 视为过期并释放引用，无人引用的数据立即删除；
+#   - 页面内显示 / 播放用 source()：返回存储的 bytes 对象本身或溢写文件路径，不复制；
+#   - 发给 Gemini 时仍有复制：part() 的字节放进生成任务的 payload，submit() 时整体哈希（任务去重）
+#     并写入 SQLite 任务队列，worker 进程再读回一份；任务结束后队列中的 payload 即被清空。
+#
+# 缓存目录位于 job_service 的私有数据目录（0700）下，不使用 /tmp 下的共享目录名。
+
+import atexit
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from job_service import DATA_DIR, pid_alive
+
+RAM_LIMIT = int(os.getenv("TOURMATE_BLOB_RAM_MB", "64")) * 1024 * 1024
+DISK_LIMIT = int(os.getenv("TOURMATE_BLOB_DISK_MB", "512")) * 1024 * 1024
+SESSION_TTL = int(os.getenv("TOURMATE_SESSION_TTL", str(2 * 3600)))
+SWEEP_INTERVAL = 60
+CACHE_ROOT = os.getenv("TOURMATE_BLOB_DIR", os.path.join(DATA_DIR, "blobs"))
+
+
+class BlobExpired(KeyError):
+    """数据已因会话过期或缓存淘汰被删除。"""
+
+
+class _Blob:
+    __slots__ = ("mime_type", "size", "data", "path", "refs", "last_used")
+
+    def __init__(self, mime_type, data):
+        self.mime_type = mime_type
+        self.size = len(data)
+        self.data = data
+        self.path = None
+        self.refs = set()
+        self.last_used = time.monotonic()
+
+
+class BlobStore:
+    """按内容哈希去重、按会话引用计数、超出内存阈值溢写磁盘的二进制存储。"""
+
+    def __init__(self, root=CACHE_ROOT, ram_limit=RAM_LIMIT, disk_limit=DISK_LIMIT, session_ttl=SESSION_TTL):
+        self._ram_limit = ram_limit
+        self._disk_limit = disk_limit
+        self._session_ttl = session_ttl
+        self._lock = threading.Lock()
+        self._blobs = {}
+        self._sessions = {}      # session_id -> 最近活动时间
+        self._ram_bytes = 0
+        self._disk_bytes = 0
+        self._last_sweep = 0.0
+
+        # 缓存目录按进程区分；清理已退出进程留下的目录
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        for name in os.listdir(root):
+            if name.isdigit() and not pid_alive(int(name)):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        self._dir = os.path.join(root, str(os.getpid()))
+        os.makedirs(self._dir, mode=0o700, exist_ok=True)
+        atexit.register(shutil.rmtree, self._dir, True)
+
+    # ---------- 读写 ----------
+
+    def put(self, data, mime_type, session_id):
+        """保存数据并为会话添加引用，返回内容哈希；相同内容只保存一份。
+
+        单个数据超过内存上限时抛出 ValueError。
+        """
+        if len(data) > self._ram_limit:
+            raise ValueError(f"Blob of {len(data)} bytes exceeds the {self._ram_limit}-byte memory limit.")
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                blob = self._blobs[digest] = _Blob(mime_type, bytes(data))
+                self._ram_bytes += blob.size
+            blob.refs.add(session_id)
+            blob.last_used = time.monotonic()
+            self._sessions[session_id] = time.monotonic()
+            self._spill()
+        return digest
+
+    def _lookup(self, digest):
+        blob = self._blobs.get(digest)
+        if blob is None:
+            raise BlobExpired(digest)
+        blob.last_used = time.monotonic()
+        return blob
+
+    def _read(self, blob):
+        if blob.data is not None:
+            return blob.data
+        with open(blob.path, "rb") as f:
+            return f.read()
+
+    def source(self, digest):
+        """给 st.audio / st.image 使用：已溢写时直接返回文件路径，避免读回内存。"""
+        with self._lock:
+            blob = self._lookup(digest)
+            return blob.path if blob.data is None else blob.data
+
+    def part(self, digest):
+        """构造 Gemini 的内联数据 part；已溢写的数据从磁盘读回。"""
+        with self._lock:
+            blob = self._lookup(digest)
+            return {"mime_type": blob.mime_type, "data": self._read(blob)}
+
+    def __contains__(self, digest):
+        return digest in self._blobs
+
+    # ---------- 会话引用 ----------
+
+    def touch(self, session_id):
+        """记录会话活动（每次 rerun 调用），并按间隔清理过期会话。"""
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = now
+            if now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            expired = [s for s, seen in self._sessions.items() if now - seen > self._session_ttl]
+            for s in expired:
+                self._release(s)
+
+    def release(self, session_id, digest=None):
+        """释放会话对某个数据（digest 为 None 时为全部数据）的引用。"""
+        with self._lock:
+            self._release(session_id, digest)
+
+    def _release(self, session_id, digest=None):
+        if digest is None:
+            self._sessions.pop(session_id, None)
+            digests = [d for d, b in self._blobs.items() if session_id in b.refs]
+        else:
+            digests = [digest] if digest in self._blobs else []
+        for d in digests:
+            blob = self._blobs[d]
+            blob.refs.discard(session_id)
+            if not blob.refs:
+                self._drop(d)
+
+    # ---------- 内存 / 磁盘管理 ----------
+
+    def _drop(self, digest):
+        blob = self._blobs.pop(digest)
+        if blob.data is not None:
+            self._ram_bytes -= blob.size
+        if blob.path is not None:
+            self._disk_bytes -= blob.size
+            try:
+                os.remove(blob.path)
+            except OSError:
+                pass
+
+    def _spill(self):
+        if self._ram_bytes <= self._ram_limit:
+            return
+        for digest, blob in sorted(self._blobs.items(), key=lambda item: item[1].last_used):
+            if self._ram_bytes <= self._ram_limit:
+                break
+            if blob.data is None or digest not in self._blobs:
+                continue
+            if blob.size > self._disk_limit:
+                self._drop(digest)
+                continue
+            # 磁盘缓存已满时淘汰磁盘上最久未使用的数据（即使仍被引用），保证两者都不超限
+            for d, b in sorted(self._blobs.items(), key=lambda item: item[1].last_used):
+                if self._disk_bytes + blob.size <= self._disk_limit:
+                    break
+                if b.data is None:
+                    self._drop(d)
+            path = os.path.join(self._dir, digest)
+            with open(path, "wb") as f:
+                f.write(blob.data)
+            blob.path, blob.data = path, None
+            self._ram_bytes -= blob.size
+            self._disk_bytes += blob.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "blobs": len(self._blobs),
+                "sessions": len(self._sessions),
+                "ram_bytes": self._ram_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+# 进程级共享实例（Streamlit 各会话共用）
+blob_store = BlobStore()
@@ -0,0 +1,542 @@
+# 本地任务服务：SQLite 任务队列 + 独立的 worker 进程池
+#
+# Streamlit 每次 rerun 都会中断正在执行的脚本，在 `submitted` 分支里直接调用 Gemini，
+# 用户一点别的按钮就前功尽弃。这里把耗时工作（图像预处理、生成、TTS）交给独立进程执行：
+# 页面只负责 submit() 拿到任务 ID 并存入 session_state，之后每次 rerun 用 wait()/get() 按 ID 取结果。
+#
+# API Key：每个 Key 对应一个独立的数据库和进程池（文件名带 Key 的哈希），
+# start_workers(api_key) 返回该 Key 的数据库路径，页面之后的 submit/wait/stream 都传这个路径，
+# 因此同时运行的几个应用各自使用自己配置的 Key，互不覆盖。
+#
+# 数据库、PID 和锁文件放在仅当前用户可访问（0700）的数据目录里，不使用 /tmp 下的共享文件名；
+# 任务参数和结果以 JSON + 二进制列保存，读取时不反序列化任意对象。
+#
+# 独立运行：GOOGLE_API_KEY=... python job_service.py --workers 2
+# （此时页面所在进程设置 TOURMATE_EXTERNAL_WORKERS=1，且使用同一个 Key）
+
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import stat
+import subprocess
+import sys
+import time
+import uuid
+from io import BytesIO
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _private_dir(path):
+    """创建（或检查）仅当前用户可访问的目录；目录是符号链接或属于其他用户时拒绝使用。"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode) or st.st_uid != os.getuid():
+            raise RuntimeError(f"Unsafe data directory: {path}")
+        if st.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+
+if os.name == "nt":
+    _DEFAULT_DATA_DIR = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")), "tourmate")
+else:
+    _DEFAULT_DATA_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tourmate")
+DATA_DIR = _private_dir(os.getenv("TOURMATE_DATA_DIR", _DEFAULT_DATA_DIR))
+DB_PATH = os.getenv("TOURMATE_JOB_DB", os.path.join(DATA_DIR, "jobs.sqlite3"))
+NUM_WORKERS = int(os.getenv("TOURMATE_WORKERS", "2"))
+POLL_INTERVAL = 0.2          # 空闲 worker / wait() 轮询间隔（秒）
+WAIT_TIMEOUT = 180           # wait()/stream() 无进展时最长等待时间（秒）
+HEARTBEAT = 5                # 进程池心跳间隔：定期刷新 PID 文件的修改时间
+HEARTBEAT_STALE = 15         # PID 文件超过该时间未刷新，视为进程池已失效（防止 PID 被复用误判）
+JOB_LEASE = 300              # 任务租约：worker 崩溃后超过该时间任务会被重新领取
+MAX_ATTEMPTS = 3             # 同一任务最多领取次数
+JOB_TTL = 24 * 3600          # 已完成任务保留时长，过期清理
+BINARY_TTL = 300             # 图像/音频结果在页面读入 blob_store 后不再需要，只短暂保留
+BINARY_KINDS = ("preprocess", "tts")
+PURGE_INTERVAL = 60          # 清理过期任务的间隔（无论队列是否空闲）
+
+_API_KEYS = {}               # db_path -> api_key，供 wait() 发现进程池失效时重新拉起
+_POOLS = {}                  # db_path -> 本进程拉起的进程池 Popen，用于判断存活并回收已退出的子进程
+_READY = set()               # 本进程已初始化表结构的数据库
+
+IN_FLIGHT = ("queued", "running")
+FINISHED = ("done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    dedup_key   TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    payload_bin BLOB,
+    result      TEXT,
+    result_bin  BLOB,
+    partial     TEXT,
+    error       TEXT,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status);
+"""
+
+
+def _connect(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _init_db(db_path=DB_PATH):
+    """建表（只在 start_workers()/main() 中调用，轮询不重复执行）。"""
+    conn = _connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # 旧版本的数据库以 pickle 保存任务，不再读取；队列中的任务都是临时的，直接重建
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+        if columns and "payload_bin" not in columns:
+            conn.execute("DROP TABLE jobs")
+        conn.executescript(_SCHEMA)
+    finally:
+        conn.close()
+
+
+def _pack(obj):
+    """编码为 JSON 文本 + 二进制：bytes 替换为 {"$bin": [偏移, 长度]}，内容依次拼接到二进制列。"""
+    chunks = []
+    offset = 0
+
+    def default(o):
+        nonlocal offset
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            ref = {"$bin": [offset, len(o)]}
+            chunks.append(o)
+            offset += len(o)
+            return ref
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    text = json.dumps(obj, default=default, ensure_ascii=False)
+    return text, b"".join(chunks)
+
+
+def _unpack(text, data):
+    if text is None:
+        return None
+
+    def hook(d):
+        if len(d) == 1 and "$bin" in d:
+            start, size = d["$bin"]
+            return bytes(data[start:start + size])
+        return d
+
+    return json.loads(text, object_hook=hook)
+
+
+def _row_to_job(row):
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "result": _unpack(row["result"], row["result_bin"]),
+        "partial": row["partial"],
+        "error": row["error"],
+    }
+
+
+# ---------- 任务处理函数（在 worker 进程中执行） ----------
+# 处理函数签名为 handler(payload, progress)，progress(text) 用于写入阶段性输出（流式生成）
+
+# 图像压缩
+def compress_image(image, max_size=(800, 800), quality=80):
+    image = image.convert("RGB")  # 保证 JPEG 兼容性
+    image.thumbnail(max_size)
+    buf = BytesIO()
+    image.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _preprocess(payload, progress):
+    from PIL import Image
+    img = Image.open(BytesIO(payload["data"]))
+    return compress_image(img, tuple(payload.get("max_size", (800, 800))), payload.get("quality", 80))
+
+
+def _generate(payload, progress):
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    model = genai.GenerativeModel(payload["model"])
+    if not payload.get("stream"):
+        response = model.generate_content(payload["contents"])
+        return getattr(response, "text", str(response))
+    text = ""
+    for chunk in model.generate_content(payload["contents"], stream=True):
+        text += getattr(chunk, "text", "")
+        progress(text)
+    return text
+
+
+def _tts(payload, progress):
+    from gtts import gTTS
+    buf = BytesIO()
+    gTTS(text=payload["text"], lang=payload["lang"]).write_to_fp(buf)
+    return buf.getvalue()
+
+
+HANDLERS = {
+    "preprocess": _preprocess,
+    "generate": _generate,
+    "tts": _tts,
+}
+
+
+# ---------- 页面侧接口 ----------
+
+def submit(kind, payload, db_path=DB_PATH):
+    """提交任务并返回任务 ID；相同 kind + payload 的排队/执行中任务会合并为同一个 ID。"""
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    text, data = _pack(payload)
+    h = hashlib.sha256(kind.encode() + b"\0" + text.encode("utf-8") + b"\0")
+    h.update(data)
+    dedup_key = h.hexdigest()
+    conn = _connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE dedup_key = ? AND status IN (?, ?) LIMIT 1",
+            (dedup_key, *IN_FLIGHT),
+        ).fetchone()
+        if row:
+            job_id = row["id"]
+        else:
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute(
+                "INSERT INTO jobs (id, kind, dedup_key, status, payload, payload_bin, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, dedup_key, text, data, now, now),
+            )
+        conn.execute("COMMIT")
+        return job_id
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _get(conn, job_id):
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row) if row else None
+
+
+def get(job_id, db_path=DB_PATH):
+    """按 ID 查询任务状态，任务不存在（已过期清理）时返回 None。"""
+    conn = _connect(db_path)
+    try:
+        return _get(conn, job_id)
+    finally:
+        conn.close()
+
+
+def _ensure_pool(db_path):
+    if not _pool_alive(db_path):
+        start_workers(_API_KEYS.get(db_path))
+
+
+def wait(job_id, timeout=WAIT_TIMEOUT, db_path=DB_PATH):
+    """轮询直到任务完成，返回任务状态。
+
+    等待期间发现进程池失效会重新拉起；超过 timeout 仍未完成时返回的任务带 error 说明，
+    页面按失败处理，不会一直转圈。
+    """
+    deadline = time.monotonic() + timeout
+    with contextlib.closing(_connect(db_path)) as conn:  # 整个轮询共用一个连接
+        while True:
+            job = _get(conn, job_id)
+            if job is None or job["status"] in FINISHED:
+                return job
+            if time.monotonic() >= deadline:
+                job["error"] = f"No worker finished the job within {timeout}s (status: {job['status']})."
+                return job
+            _ensure_pool(db_path)
+            time.sleep(POLL_INTERVAL)
+
+
+def stream(job_id, timeout=WAIT_TIMEOUT, db_path=DB_PATH):
+    """逐段产出生成任务的新增文本（需以 stream=True 提交）。
+
+    任务失败、过期或超过 timeout 秒没有新内容时抛出 RuntimeError。
+    """
+    sent = 0
+    deadline = time.monotonic() + timeout
+    with contextlib.closing(_connect(db_path)) as conn:  # 整个轮询共用一个连接
+        while True:
+            job = _get(conn, job_id)
+            if job is None:
+                raise RuntimeError("Job expired.")
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"])
+            text = job["result"] if job["status"] == "done" else (job["partial"] or "")
+            if len(text) > sent:
+                yield text[sent:]
+                sent = len(text)
+                deadline = time.monotonic() + timeout
+            if job["status"] == "done":
+                return
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"No worker progress on the job within {timeout}s (status: {job['status']}).")
+            _ensure_pool(db_path)
+            time.sleep(POLL_INTERVAL)
+
+
+# ---------- 进程池管理 ----------
+
+def db_path_for(api_key):
+    """每个 API Key 使用独立的数据库（和进程池）；未提供 Key 时使用默认数据库。"""
+    if not api_key:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}-{hashlib.sha256(api_key.encode()).hexdigest()[:12]}{ext}"
+
+
+@contextlib.contextmanager
+def _pool_lock(db_path):
+    # 跨进程互斥：同一时刻只有一个会话/进程在检查并启动进程池
+    fd = os.open(db_path + ".lock", os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    with os.fdopen(fd, "r+") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_pid(db_path):
+    try:
+        with open(db_path + ".pid") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_pid(db_path, pid):
+    # 不跟随符号链接
+    fd = os.open(db_path + ".pid", os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(str(pid))
+
+
+def pid_alive(pid):
+    """进程是否仍在运行。Windows 上 os.kill(pid, 0) 会结束目标进程，改用 OpenProcess 查询。"""
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _pool_alive(db_path=DB_PATH):
+    """PID 对应进程存在且心跳新鲜才算存活；PID 被其他进程复用时心跳会过期。"""
+    pid = _read_pid(db_path)
+    proc = _POOLS.get(db_path)
+    # 本进程拉起的进程池：poll() 判断是否已退出，同时回收僵尸进程
+    if proc is not None and proc.poll() is not None:
+        del _POOLS[db_path]
+        if pid == proc.pid:
+            return False
+    if pid is None or not pid_alive(pid):
+        return False
+    try:
+        return time.time() - os.path.getmtime(db_path + ".pid") < HEARTBEAT_STALE
+    except OSError:
+        return False
+
+
+def start_workers(api_key=None, workers=NUM_WORKERS):
+    """确保该 API Key 的后台 worker 进程池在运行，返回其数据库路径。
+
+    进程独立于 Streamlit 会话，rerun 不会中断它。
+    """
+    db_path = db_path_for(api_key)
+    _API_KEYS[db_path] = api_key
+    if db_path not in _READY:
+        _init_db(db_path)
+        _READY.add(db_path)
+    if os.getenv("TOURMATE_EXTERNAL_WORKERS") or _pool_alive(db_path):
+        return db_path
+    with _pool_lock(db_path):
+        if _pool_alive(db_path):
+            return db_path
+        env = dict(os.environ)
+        if api_key:
+            env["GOOGLE_API_KEY"] = api_key  # 通过环境变量传递，避免出现在进程命令行里
+        try:
+            proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--workers", str(workers), "--db", db_path],
+                env=env,
+                stdin=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError as e:
+            # 启动失败时不影响页面渲染；wait() 会重试并在超时后报错
+            sys.stderr.write(f"job_service: failed to start workers: {e}\n")
+            return db_path
+        # 由父进程在持锁期间写入 PID，其他会话不会在子进程启动的空档里重复拉起
+        _write_pid(db_path, proc.pid)
+        _POOLS[db_path] = proc
+    return db_path
+
+
+# ---------- worker 进程 ----------
+
+def _claim(conn):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 租约过期且重试次数用尽的任务直接判定失败，避免 wait() 永远等待
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'worker lost', updated_at = ? "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, now, MAX_ATTEMPTS),
+        )
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+            "ORDER BY created_at LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+                "WHERE id = ?",
+                (now + JOB_LEASE, now, row["id"]),
+            )
+        conn.execute("COMMIT")
+        return row
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _finish(conn, job_id, status, result=None, error=None):
+    # 完成后清空 payload（图像等原始数据），只保留结果，控制数据库体积
+    text, data = _pack(result) if result is not None else (None, None)
+    conn.execute(
+        "UPDATE jobs SET status = ?, result = ?, result_bin = ?, error = ?, payload = '', payload_bin = NULL, "
+        "lease_until = NULL, updated_at = ? WHERE id = ?",
+        (status, text, data, error, time.time(), job_id),
+    )
+
+
+def _progress(conn, job_id, text):
+    # 同时续租，避免长时间的流式生成在执行中被其他 worker 重新领取
+    now = time.time()
+    conn.execute(
+        "UPDATE jobs SET partial = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+        (text, now + JOB_LEASE, now, job_id),
+    )
+
+
+def _purge(conn):
+    now = time.time()
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+        (*FINISHED, now - JOB_TTL),
+    )
+    # 二进制结果不受 blob_store 磁盘上限约束，尽快删除
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN (?, ?) AND kind IN (?, ?) AND updated_at < ?",
+        (*FINISHED, *BINARY_KINDS, now - BINARY_TTL),
+    )
+
+
+def _worker_main(db_path, supervisor):
+    conn = _connect(db_path)
+    last_purge = 0.0
+    while os.getppid() == supervisor:  # 主进程被强制结束后不留下孤儿 worker
+        # 按固定间隔清理，不依赖队列是否空闲
+        if time.time() - last_purge > PURGE_INTERVAL:
+            _purge(conn)
+            last_purge = time.time()
+        row = _claim(conn)
+        if row is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        try:
+            result = HANDLERS[row["kind"]](_unpack(row["payload"], row["payload_bin"]),
+                                           lambda text: _progress(conn, row["id"], text))
+            _finish(conn, row["id"], "done", result=result)
+        except Exception as e:
+            _finish(conn, row["id"], "failed", error=f"{type(e).__name__}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cultural-Tour-Mate background job workers")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--db", default=db_path_for(os.getenv("GOOGLE_API_KEY")))
+    args = parser.parse_args()
+    db_path, pid = args.db, os.getpid()
+
+    with _pool_lock(db_path):
+        # 由 start_workers() 拉起时 PID 文件已是本进程；手动运行时若已有存活进程池则退出
+        if _read_pid(db_path) not in (None, pid) and _pool_alive(db_path):
+            sys.stderr.write(f"job_service: workers already running for {db_path}\n")
+            return
+        _write_pid(db_path, pid)
+        _init_db(db_path)  # 先建表，避免多个 worker 同时初始化
+
+    procs = [multiprocessing.Process(target=_worker_main, args=(db_path, pid), daemon=True)
+             for _ in range(max(1, args.workers))]
+    for p in procs:
+        p.start()
+    try:
+        while _read_pid(db_path) == pid:  # PID 文件被其他进程池接管时退出
+            os.utime(db_path + ".pid")  # 心跳
+            # 某个 worker 异常退出时补一个新的
+            for i, p in enumerate(procs):
+                if not p.is_alive():
+                    procs[i] = multiprocessing.Process(target=_worker_main, args=(db_path, pid), daemon=True)
+                    procs[i].start()
+            time.sleep(HEARTBEAT)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 只删除属于本进程池的 PID 文件
+        with _pool_lock(db_path):
+            if _read_pid(db_path) == pid:
+                os.remove(db_path + ".pid")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# 进程内请求合并（single-flight）
+#
+# 旅行团几十人同时对同一展品拍照问“这是什么？”时，每个会话都会单独调用一次 Gemini。
+# Streamlit 的所有会话运行在同一进程的不同线程里，这里用模块级的 SingleFlight：
+# 相同 key 的并发请求只执行一次，其余请求等待同一个结果（支持流式逐段回放）。
+
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def make_key(image_digest, prompt, lang):
+    """按图像内容哈希（blob_store 返回的 digest）、问题文本和语言生成合并 key。"""
+    h = hashlib.sha256()
+    h.update(image_digest.encode("ascii"))
+    h.update(prompt.strip().encode("utf-8"))
+    h.update(b"\0" + lang.encode("utf-8"))
+    return h.hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.finished_at = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """相同 key 的调用共享同一次执行。
+
+    执行放在独立线程池里，不跟随某个会话的脚本线程：发起者被 rerun 打断时，
+    等待者仍能拿到结果。完成后的结果保留 linger 秒，供稍晚到达的相同问题复用；
+    需要跨越更长时间的结果（如 rerun 后回来的会话）应由调用方按任务 ID 自行保存。
+    """
+
+    def __init__(self, max_workers=8, linger=60):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="single-flight")
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._linger = linger
+        self._stats = {"calls": 0, "executed": 0, "coalesced": 0, "failed": 0}
+
+    def _run(self, flight, fn):
+        try:
+            for chunk in fn():
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats["failed"] += 1
+        finally:
+            with flight.cond:
+                flight.done = True
+                flight.finished_at = time.monotonic()
+                flight.cond.notify_all()
+
+    def _join(self, key, fn):
+        now = time.monotonic()
+        with self._lock:
+            # 清理过期结果；失败的执行不保留，下次重新调用
+            for k, f in list(self._flights.items()):
+                if f.done and (f.error is not None or now - f.finished_at > self._linger):
+                    del self._flights[k]
+            self._stats["calls"] += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self._stats["executed"] += 1
+                self._executor.submit(self._run, flight, fn)
+            else:
+                self._stats["coalesced"] += 1
+            flight.waiters += 1
+        return flight
+
+    def stream(self, key, fn):
+        """fn 返回可迭代的分段结果；逐段产出，后加入的等待者会先回放已有分段。"""
+        flight = self._join(key, fn)
+        i = 0
+        while True:
+            with flight.cond:
+                while i >= len(flight.chunks) and not flight.done:
+                    flight.cond.wait()
+                chunks = flight.chunks[i:]
+                done = flight.done
+            for chunk in chunks:
+                yield chunk
+            i += len(chunks)
+            if done and i >= len(flight.chunks):
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    def stats(self):
+        """合并统计：calls 总调用数，executed 实际执行数，coalesced 被合并（未执行）的调用数，failed 执行失败数。
+
+        每次调用只计一次：calls = executed + coalesced。
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = sum(1 for f in self._flights.values() if not f.done)
+            stats["max_waiters"] = max((f.waiters for f in self._flights.values()), default=0)
+        return stats
+
+
+# Gemini 生成请求的全局合并层
+generate_flight = SingleFlight()